@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 """
 Rebalance a mock-stock portfolio so that each ticker in the market has the same total value.
-Supports saving/loading the portfolio to/from a CSV file. 
-- If a portfolio text file is provided, updates the saved CSV accordingly.
-- If no portfolio text file is provided, uses the saved CSV.
-- After generating trades, applies them to the in-memory portfolio and writes out the updated CSV.
+Supports saving/loading the portfolio to/from a JSON file.
+- If a portfolio text file is provided, updates the saved JSON accordingly.
+- If no portfolio text file is provided, uses the saved JSON.
+- After generating trades, applies them to the in-memory portfolio and writes out the updated JSON.
 
 Usage:
     python rebalance_all.py --market market.txt [--portfolio portfolio.txt]
@@ -14,16 +14,40 @@ Outputs a series of commands of the form:
     !buy TICKER QTY
 
 Sell commands are printed first to free up cash, then buys.  
-At the end, the updated portfolio (quantities and cash) is saved to "saved_portfolio.csv".
+At the end, the updated portfolio (quantities and cash) is saved to "saved_portfolio.json".
 """
 
 import argparse
+import functools
+import itertools
+import json
 import re
-import math
+import sys
 import os
-import pandas as pd
+import numpy as np
 
-SAVED_CSV = "saved_portfolio.csv"
+SAVED_JSON = "saved_portfolio.json"
+
+# Cash amount on the first non-blank line after the header; the € sign is optional
+_CASH_RE = re.compile(r"💰 Cash[^\n]*\n\s*€?\s*([\d,.]+)[^\S\n]*$", re.MULTILINE)
+_TICKER_QTY_RE = re.compile(r"\(([^()\n]+)\):\s*(\d+)\s*shares")
+_TICKER_RE = re.compile(r"\(([^()\n]+)\)[^(\n]*\n\s*€([\d.]+)")
+
+_IO_BUFFER = 1 << 20
+
+def _read_text(path):
+    """
+    Read a whole text file in one go through a large buffer,
+    hinting the kernel that access is sequential where supported.
+    """
+    with open(path, "r", encoding="utf-8", buffering=_IO_BUFFER) as f:
+        if hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                # Only a hint; pipes and other unseekable inputs reject it
+                pass
+        return f.read()
 
 def parse_portfolio_text(path):
     """
@@ -37,68 +61,66 @@ def parse_portfolio_text(path):
     Returns:
         cash (float), stocks (dict: ticker -> quantity(int))
     """
-    with open(path, "r", encoding="utf-8") as f:
-        raw_lines = [line.strip() for line in f.readlines()]
-    lines = [line for line in raw_lines if line]
+    path = os.fspath(path)
+    st = os.stat(path)
+    cash, stocks = _parse_portfolio_text_cached(path, st.st_mtime_ns, st.st_size)
+    # Copy so callers can mutate the result without touching the cache
+    return cash, dict(stocks)
+
+@functools.lru_cache(maxsize=8)
+def _parse_portfolio_text_cached(path, mtime_ns, size):
+    """
+    Parse the portfolio text file; the cache is keyed on (path, mtime, size)
+    so an edited file is re-read.
+    """
+    text = _read_text(path)
 
     cash = 0.0
     stocks = {}
 
-    for i, line in enumerate(lines):
-        if line.startswith("💰 Cash"):
-            if i + 1 < len(lines):
-                cash_str = lines[i+1].lstrip("€").replace(",", "")
-                cash = float(cash_str)
-            break
-
-    for i, line in enumerate(lines):
-        if line.startswith("📈 Stocks Owned"):
-            for j in range(i+1, len(lines)):
-                m = re.match(r".*\((?P<ticker>[^)]+)\):\s*(?P<qty>\d+)\s*shares", lines[j])
-                if m:
-                    ticker = m.group("ticker").strip()
-                    qty = int(m.group("qty"))
-                    stocks[ticker] = qty
-            break
+    if "💰 Cash" in text:
+        m = _CASH_RE.search(text)
+        if not m:
+            raise ValueError(f"Could not parse the cash amount after '💰 Cash' in '{path}'")
+        cash = float(m.group(1).replace(",", ""))
+
+    start = text.find("📈 Stocks Owned")
+    if start != -1:
+        for m in _TICKER_QTY_RE.finditer(text, start):
+            ticker = m.group(1).strip()
+            qty = int(m.group(2))
+            stocks[ticker] = qty
 
     return cash, stocks
 
 def load_saved_portfolio():
     """
-    Load portfolio from SAVED_CSV. Expects CSV with columns [ticker, quantity].
-    Includes a row with ticker="CASH" and quantity=<cash amount>.
+    Load portfolio from SAVED_JSON. Expects a JSON object of the form
+        {"cash": <cash amount>, "stocks": {ticker: quantity, ...}}
     Returns:
         cash (float), stocks (dict: ticker -> quantity(int))
     """
-    if not os.path.exists(SAVED_CSV):
-        raise FileNotFoundError(f"No saved portfolio CSV found at '{SAVED_CSV}'. Provide a portfolio text file to initialize.")
-    df = pd.read_csv(SAVED_CSV)
-    if "ticker" not in df.columns or "quantity" not in df.columns:
-        raise ValueError(f"Saved CSV '{SAVED_CSV}' must have columns: ticker, quantity")
-    cash_row = df[df["ticker"] == "CASH"]
-    if cash_row.empty:
-        raise ValueError(f"Saved CSV '{SAVED_CSV}' missing CASH row. Provide a portfolio text file to initialize.")
-    cash = float(cash_row.iloc[0]["quantity"])
-    stocks = {}
-    for _, row in df[df["ticker"] != "CASH"].iterrows():
-        stocks[row["ticker"]] = int(row["quantity"])
+    if not os.path.exists(SAVED_JSON):
+        raise FileNotFoundError(f"No saved portfolio found at '{SAVED_JSON}'. Provide a portfolio text file to initialize.")
+    with open(SAVED_JSON, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    try:
+        cash = float(data["cash"])
+        if not isinstance(data["stocks"], dict):
+            raise TypeError("stocks must be an object")
+        stocks = {str(t): int(qty) for t, qty in data["stocks"].items()}
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"Saved portfolio '{SAVED_JSON}' must have a numeric cash and a stocks object of ticker: quantity. Provide a portfolio text file to initialize.") from None
     return cash, stocks
 
-def save_portfolio_csv(cash, stocks):
+def save_portfolio(cash, stocks):
     """
-    Save the portfolio to SAVED_CSV as a CSV with columns:
-        ticker, quantity
-    Includes a row with ticker="CASH" for the cash amount.
+    Save the portfolio to SAVED_JSON as
+        {"cash": <cash amount>, "stocks": {ticker: quantity, ...}}
     """
-    rows = []
-    # Cash row first
-    rows.append({"ticker": "CASH", "quantity": cash})
-    # Then one row per ticker
-    for t, qty in stocks.items():
-        rows.append({"ticker": t, "quantity": qty})
-    df = pd.DataFrame(rows)
-    df.to_csv(SAVED_CSV, index=False)
-    print(f"# Saved updated portfolio to '{SAVED_CSV}'")
+    with open(SAVED_JSON, "w", encoding="utf-8", buffering=_IO_BUFFER) as f:
+        json.dump({"cash": cash, "stocks": stocks}, f)
+        f.write("\n")
 
 def parse_market(path):
     """
@@ -114,124 +136,116 @@ def parse_market(path):
     Returns:
         prices (dict: ticker -> price(float))
     """
-    with open(path, "r", encoding="utf-8") as f:
-        raw_lines = [line.strip() for line in f.readlines()]
-    lines = [line for line in raw_lines if line]
+    path = os.fspath(path)
+    st = os.stat(path)
+    # Copy so callers can mutate the result without touching the cache
+    return dict(_parse_market_cached(path, st.st_mtime_ns, st.st_size))
+
+@functools.lru_cache(maxsize=8)
+def _parse_market_cached(path, mtime_ns, size):
+    """
+    Parse the market summary file; the cache is keyed on (path, mtime, size)
+    so an edited file is re-read.
+    """
+    text = _read_text(path)
 
     prices = {}
-    i = 0
-    while i < len(lines):
-        m = re.match(r".*\((?P<ticker>[^)]+)\)", lines[i])
-        if m and (i+1) < len(lines):
-            ticker = m.group("ticker").strip()
-            price_line = lines[i+1]
-            pm = re.match(r"€(?P<price>[\d\.]+)", price_line)
-            if pm:
-                prices[ticker] = float(pm.group("price"))
-                i += 2
-                continue
-        i += 1
+    for m in _TICKER_RE.finditer(text):
+        ticker = m.group(1).strip()
+        prices[ticker] = float(m.group(2))
 
     return prices
 
-def rebalance(cash, stocks, prices):
+def _rebalance_kernel(p, old, cash):
     """
-    Given:
-        cash   = available cash in €
-        stocks = { ticker: quantity }
-        prices = { ticker: price(float) }
-    Compute trades to rebalance across all tickers in prices, 
-    returning two lists: sells, buys. 
-    After printing them, the calling code should apply the trades to update cash/stocks.
+    Given price array p, current share array old and available cash,
+    return the new share counts giving every ticker the same value
+    and the cash left over after trading to them.
     """
-    all_tickers = sorted(prices.keys())
-    N = len(all_tickers)
-
     # Current values
-    current_value = {}
-    for t in all_tickers:
-        old_qty = stocks.get(t, 0)
-        current_value[t] = old_qty * prices[t]
-
-    total_stock_value = sum(current_value.values())
-    total_portfolio_value = total_stock_value + cash
-    target_value = total_portfolio_value / N
+    current_value = old * p
+    total_portfolio_value = current_value.sum() + cash
+    target_value = total_portfolio_value / len(p)
 
     # Compute ideal (floating) shares and floor
-    ideal_shares = {}
-    new_shares = {}
-    for t in all_tickers:
-        p = prices[t]
-        f = target_value / p
-        ideal_shares[t] = f
-        new_shares[t] = int(math.floor(f))
+    ideal = target_value / p
+    new = np.floor(ideal).astype(np.int64)
 
     # Compute leftover cash after flooring
-    cost_floor = sum(new_shares[t] * prices[t] for t in all_tickers)
-    remaining_cash = total_portfolio_value - cost_floor
+    remaining_cash = total_portfolio_value - (new * p).sum()
+
+    # Nothing more is affordable (e.g. an already balanced portfolio): skip the sort
+    if remaining_cash < p.min():
+        return new, remaining_cash
 
     # Distribute leftover cash by largest fractional remainders
-    remainders = []
-    for t in all_tickers:
-        remainder = ideal_shares[t] - new_shares[t]
-        remainders.append((t, remainder))
-    remainders.sort(key=lambda x: x[1], reverse=True)
-    for t, rem in remainders:
-        price_t = prices[t]
-        if price_t <= remaining_cash:
-            new_shares[t] += 1
-            remaining_cash -= price_t
+    rem = ideal - new
+    order = np.argsort(-rem, kind="stable")
+    # The leading run of tickers whose cumulative price fits is bought in one go;
+    # after the first unaffordable ticker, cheaper ones further down may still fit.
+    cumprice = np.cumsum(p[order])
+    k = np.searchsorted(cumprice, remaining_cash, side="right")
+    new[order[:k]] += 1
+    if k:
+        remaining_cash -= cumprice[k-1]
+    for i in order[k:]:
+        if p[i] <= remaining_cash:
+            new[i] += 1
+            remaining_cash -= p[i]
+
+    return new, remaining_cash
 
-    # Build sell/buy lists
-    sells = []
-    buys = []
-    for t in all_tickers:
-        old_qty = stocks.get(t, 0)
-        diff = new_shares[t] - old_qty
-        if diff < 0:
-            sells.append((t, -diff))
-        elif diff > 0:
-            buys.append((t, diff))
-
-    # Return in order: sells then buys
-    return sells, buys
-
-def apply_trades(cash, stocks, prices, sells, buys):
+def rebalance(cash, stocks, prices):
     """
-    Apply sell orders first (takes cash += qty * price, stocks[t] -= qty),
-    then apply buys (cash -= qty*price, stocks[t] += qty).
-    Returns updated (cash, stocks).
+    Given:
+        cash   = available cash in €
+        stocks = { ticker: quantity }
+        prices = { ticker: price(float) }
+    Compute trades to rebalance across all tickers in prices,
+    returning two lists: sells, buys,
+    plus the portfolio after those trades: cash, stocks.
+    Holdings of tickers not in prices are carried over unchanged.
     """
-    # Process sells
-    for t, qty in sells:
-        if qty <= 0:
-            continue
-        if t not in stocks or stocks[t] < qty:
-            raise ValueError(f"Cannot sell {qty} of {t}: only have {stocks.get(t, 0)} shares.")
-        cash += qty * prices[t]
-        stocks[t] -= qty
-        if stocks[t] == 0:
-            del stocks[t]
-
-    # Process buys
-    for t, qty in buys:
-        cost = qty * prices[t]
-        if cost > cash + 1e-8:  # small tolerance
-            raise ValueError(f"Not enough cash to buy {qty} of {t}: need {cost:.2f}, have {cash:.2f}")
-        cash -= cost
-        stocks[t] = stocks.get(t, 0) + qty
+    # Tickers keep the market file's order; only the trade lists are sorted
+    all_tickers = list(prices.keys())
+    N = len(all_tickers)
+    p = np.fromiter(prices.values(), dtype=np.float64, count=N)
+    if not (p > 0).all():
+        bad = [t for t, price in zip(all_tickers, p.tolist()) if not price > 0]
+        raise ValueError(f"Cannot rebalance with non-positive prices for: {', '.join(bad)}")
+    # One pass over the holdings, with the lookups driven from C by map()
+    old = np.fromiter(map(stocks.get, all_tickers, itertools.repeat(0, N)), dtype=np.int64, count=N)
+
+    new, remaining_cash = _rebalance_kernel(p, old, float(cash))
+    # Check the result is a valid portfolio before it is printed or saved
+    if remaining_cash < -1e-8:  # small tolerance
+        raise ValueError(f"Not enough cash for the rebalanced portfolio: short by {-remaining_cash:.2f}")
+    if (new < 0).any():
+        raise ValueError("Rebalance produced negative share counts.")
 
-    return cash, stocks
+    # Build sell/buy lists
+    diff = new - old
+    d = diff.tolist()
+    sells = sorted((all_tickers[i], -d[i]) for i in np.flatnonzero(diff < 0).tolist())
+    buys = sorted((all_tickers[i], d[i]) for i in np.flatnonzero(diff > 0).tolist())
+
+    # Post-trade portfolio, dropping tickers sold down to zero
+    new_stocks = dict(stocks)
+    new_stocks.update(zip(all_tickers, new.tolist()))
+    new_stocks = {t: qty for t, qty in new_stocks.items() if qty}
+
+    # Return the trades (sells then buys) and the post-trade cash/stocks
+    return sells, buys, float(remaining_cash), new_stocks
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Rebalance a mock-stock portfolio and persist to CSV."
+        description="Rebalance a mock-stock portfolio and persist to JSON."
     )
     parser.add_argument(
         "--portfolio",
         "-p",
         required=False,
-        help="Path to the portfolio text file (cash + stocks owned). If omitted, loads from saved CSV."
+        help="Path to the portfolio text file (cash + stocks owned). If omitted, loads from saved JSON."
     )
     parser.add_argument(
         "--market",
@@ -240,36 +254,37 @@ def main():
         help="Path to the market summary text file (ticker prices)."
     )
     args = parser.parse_args()
+    # Output is collected and written to stdout in one go at the end
+    out = []
 
     # 1) Load or initialize portfolio
     if args.portfolio:
-        # Parse provided portfolio, then overwrite saved CSV
+        # Parse provided portfolio, then overwrite saved JSON
         cash, stocks = parse_portfolio_text(args.portfolio)
-        save_portfolio_csv(cash, stocks)
+        save_portfolio(cash, stocks)
+        out.append(f"# Saved updated portfolio to '{SAVED_JSON}'")
     else:
-        # Load from existing CSV
+        # Load from existing JSON
         cash, stocks = load_saved_portfolio()
 
     # 2) Parse market prices
     prices = parse_market(args.market)
 
     # 3) Compute trades to rebalance across all market tickers
-    sells, buys = rebalance(cash, stocks, prices)
+    sells, buys, cash, stocks = rebalance(cash, stocks, prices)
 
     # 4) Output sell commands first
     if not sells and not buys:
-        print("# Portfolio is already balanced (or no trades needed).")
+        out.append("# Portfolio is already balanced (or no trades needed).")
     else:
-        for t, qty in sells:
-            print(f"!sell {t} {qty}")
-        for t, qty in buys:
-            print(f"!buy {t} {qty}")
+        out.extend([f"!sell {t} {qty}" for t, qty in sells])
+        out.extend([f"!buy {t} {qty}" for t, qty in buys])
 
-    # 5) Apply trades to update in-memory portfolio
-    cash, stocks = apply_trades(cash, stocks, prices, sells, buys)
+    # 5) Save updated portfolio to JSON
+    save_portfolio(cash, stocks)
+    out.append(f"# Saved updated portfolio to '{SAVED_JSON}'")
 
-    # 6) Save updated portfolio to CSV
-    save_portfolio_csv(cash, stocks)
+    sys.stdout.write("\n".join(out) + "\n")
 
 if __name__ == "__main__":
     main()